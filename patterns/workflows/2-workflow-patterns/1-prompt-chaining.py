@@ -1,9 +1,21 @@
 from typing import Optional
-from datetime import datetime
-from pydantic import BaseModel, Field
-from openai import OpenAI
+from collections import Counter, defaultdict
+from datetime import date
+from functools import lru_cache, wraps
+from pydantic import BaseModel, ConfigDict, Field, ValidationError
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+import asyncio
+import diskcache
+import hashlib
+import httpx
+import json
+import nest_asyncio
 import os
 import logging
+import re
+import time
+
+nest_asyncio.apply()
 
 # Set up logging configuration
 logging.basicConfig(
@@ -13,8 +25,26 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# HTTP/2 multiplexes the concurrent requests over a few pooled connections, so
+# they don't each pay for a new TLS handshake
+client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    http_client=DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=100, max_connections=200),
+        timeout=httpx.Timeout(60.0, connect=5.0),
+    ),
+)
 model = "gpt-4o"
+# The gate is a simple classifier that sees every request (most of which fail it),
+# a much cheaper and faster model is good enough there
+cheap_model = "gpt-4o-mini"
+
+# Per-stage models, override with environment variables to A/B test other models
+stage_models = {
+    "extract": os.getenv("EXTRACT_MODEL", cheap_model),
+    "parse_and_confirm": os.getenv("PARSE_AND_CONFIRM_MODEL", model),
+}
 
 # --------------------------------------------------------------
 # Step 1: Define the data models for each stage
@@ -24,6 +54,8 @@ model = "gpt-4o"
 class EventExtraction(BaseModel):
     """First LLM call: Extract basic event information"""
 
+    model_config = ConfigDict(extra="forbid")
+
     description: str = Field(description="Raw description of the event")
     is_calendar_event: bool = Field(
         description="Whether this text describes a calendar event"
@@ -32,7 +64,9 @@ class EventExtraction(BaseModel):
 
 
 class EventDetails(BaseModel):
-    """Second LLM call: Parse specific event details"""
+    """Specific event details"""
+
+    model_config = ConfigDict(extra="forbid")
 
     name: str = Field(description="Name of the event")
     date: str = Field(
@@ -43,7 +77,9 @@ class EventDetails(BaseModel):
 
 
 class EventConfirmation(BaseModel):
-    """Third LLM call: Generate confirmation message"""
+    """Confirmation message for the event"""
+
+    model_config = ConfigDict(extra="forbid")
 
     confirmation_message: str = Field(
         description="Natural language confirmation message"
@@ -53,79 +89,227 @@ class EventConfirmation(BaseModel):
     )
 
 
+class ParsedAndConfirmed(BaseModel):
+    """Second LLM call: Parse event details and generate the confirmation"""
+
+    model_config = ConfigDict(extra="forbid")
+
+    # No field descriptions here: strict mode doesn't allow keys next to a $ref, the
+    # docstrings of the nested models already describe them
+    details: EventDetails
+    confirmation: EventConfirmation
+
+
+def json_schema_format(response_model: type[BaseModel]) -> dict:
+    """Strict JSON schema response format for a model"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_model.__name__,
+            "schema": response_model.model_json_schema(),
+            "strict": True,
+        },
+    }
+
+
+# Derive the JSON schemas once at import time. .parse() rebuilds the strict schema
+# from the model on every call.
+response_formats = {
+    EventExtraction: json_schema_format(EventExtraction),
+    ParsedAndConfirmed: json_schema_format(ParsedAndConfirmed),
+}
+
+
 # --------------------------------------------------------------
 # Step 2: Define the functions
 # --------------------------------------------------------------
 
+# The static instructions are defined once. The date changes between calls, so it is
+# appended at the end of the system prompt: OpenAI caches the longest common prompt
+# prefix, and keeping that part static lets every call reuse it.
+extract_system_prompt = "Analyze if the text describes a calendar event."
+parse_and_confirm_system_prompt = (
+    "Extract detailed event information. When dates reference 'next Tuesday' or "
+    "similar relative dates, use the current date below as reference. Then generate "
+    "a natural confirmation message for the event. Sign of with your name; Susie"
+)
 
-def extract_event_info(user_input: str) -> EventExtraction:
-    """First LLM call to determine if input is a calendar event"""
-    logger.info("Starting event extraction analysis")
-    logger.debug(f"Input text: {user_input}")
 
-    today = datetime.now()
-    date_context = f"Today is {today.strftime('%A, %B %d, %Y')}."
+# Cheap pre-filter in front of the gate: inputs that mention neither a scheduling
+# word nor a day or time can't be calendar events, so they are rejected without an
+# LLM call. Anything that matches still goes through the model.
+calendar_keywords = re.compile(
+    r"\b(meet(ings?|ups?)?|(re)?schedul(e[ds]?|ing)|calls?|appointments?|invite|"
+    r"events?|calendar|book|remind(ers?)?|lunch|dinner|breakfast|coffee|drinks|"
+    r"sync|standup|visit|offsite|catch[- ]?up|interview|party|conference|webinar|"
+    r"session|class|deadline|set up|organi[sz]e|arrange|plan)\b",
+    re.IGNORECASE,
+)
+time_tokens = re.compile(
+    r"\b(today|tonight|tomorrow|noon|midnight|morning|afternoon|evening|weekend|"
+    r"(next|this) (week|month)|(mon|tues|wednes|thurs|fri|satur|sun)day|"
+    r"jan(uary)?|feb(ruary)?|mar(ch)?|apr(il)?|may|june?|july?|aug(ust)?|"
+    r"sep(t(ember)?)?|oct(ober)?|nov(ember)?|dec(ember)?|"
+    r"\d{1,2}(st|nd|rd|th)|\d{1,2}(:\d{2})?\s*(am|pm)|\d{1,2}:\d{2}|"
+    r"\d{4}-\d{2}-\d{2}|\d{1,2}/\d{1,2})\b",
+    re.IGNORECASE,
+)
 
-    completion = client.beta.chat.completions.parse(
-        model=model,
-        messages=[
-            {
-                "role": "system",
-                "content": f"{date_context} Analyze if the text describes a calendar event.",
-            },
-            {"role": "user", "content": user_input},
-        ],
-        response_format=EventExtraction,
+
+def might_be_calendar_event(user_input: str) -> bool:
+    return bool(calendar_keywords.search(user_input) or time_tokens.search(user_input))
+
+
+@lru_cache(maxsize=1)
+def get_date_context(day_ordinal: int) -> str:
+    """Format the date context once per day instead of on every request"""
+    return f"Today is {date.fromordinal(day_ordinal).strftime('%A, %B %d, %Y')}."
+
+
+# Token usage per stage, a low cached_tokens rate means the prompt prefix isn't reused
+usage_totals = defaultdict(Counter)
+
+
+def log_usage(stage: str, completion) -> None:
+    """Log the token usage of a stage so the model choice per stage can be compared"""
+    usage = completion.usage
+    details = usage.prompt_tokens_details
+    cached_tokens = (details.cached_tokens or 0) if details else 0
+    hit_rate = cached_tokens / usage.prompt_tokens if usage.prompt_tokens else 0.0
+    usage_totals[stage].update(
+        calls=1,
+        prompt_tokens=usage.prompt_tokens,
+        cached_tokens=cached_tokens,
+        completion_tokens=usage.completion_tokens,
     )
-    result = completion.choices[0].message.parsed
     logger.info(
-        f"Extraction complete - Is calendar event: {result.is_calendar_event}, Confidence: {result.confidence_score:.2f}"
+        f"Usage [{stage}] - Model: {completion.model}, Prompt tokens: {usage.prompt_tokens}, Cached tokens: {cached_tokens} ({hit_rate:.0%}), Completion tokens: {usage.completion_tokens}"
     )
-    return result
 
 
-def parse_event_details(description: str) -> EventDetails:
-    """Second LLM call to extract specific event details"""
-    logger.info("Starting event details parsing")
+def log_usage_summary() -> None:
+    """Log the token usage and prompt cache hit rate per stage for the session"""
+    for stage, totals in usage_totals.items():
+        hit_rate = totals["cached_tokens"] / max(totals["prompt_tokens"], 1)
+        logger.info(
+            f"Session usage [{stage}] - Calls: {totals['calls']}, Prompt tokens: {totals['prompt_tokens']}, Cached tokens: {totals['cached_tokens']} ({hit_rate:.0%}), Completion tokens: {totals['completion_tokens']}"
+        )
+
+
+# Disk cache for LLM results during development, LLM_CACHE_DISABLE=1 turns it off
+llm_cache = diskcache.Cache(".llm_cache")
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", 7 * 24 * 60 * 60))
 
-    today = datetime.now()
-    date_context = f"Today is {today.strftime('%A, %B %d, %Y')}."
 
-    completion = client.beta.chat.completions.parse(
+def request_key(request: dict) -> str:
+    """
+    Stable SHA-256 key for a request. Response models are keyed by their response
+    format, so changing a model's schema invalidates its cached results.
+    """
+    payload = json.dumps(
+        request,
+        sort_keys=True,
+        default=lambda o: response_formats.get(o) or repr(o),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def cached_completion(func):
+    """Cache the parsed result of a structured LLM call on disk, keyed on the request"""
+
+    @wraps(func)
+    async def wrapper(**request):
+        if os.getenv("LLM_CACHE_DISABLE") == "1":
+            return await func(**request)
+
+        response_model = request["response_model"]
+        key = request_key({"function": func.__name__, **request})
+        cached = llm_cache.get(key)
+        if cached is not None:
+            try:
+                result = response_model.model_validate_json(cached)
+            except ValidationError:
+                logger.warning(f"Dropping stale LLM cache entry for {func.__name__}")
+                llm_cache.delete(key)
+            else:
+                logger.info(f"LLM cache hit for {func.__name__}")
+                return result
+
+        result = await func(**request)
+        llm_cache.set(key, result.model_dump_json(), expire=LLM_CACHE_TTL)
+        return result
+
+    return wrapper
+
+
+@cached_completion
+async def parse_completion(
+    *, stage: str, model: str, messages: list, response_model: type[BaseModel]
+):
+    """Run a structured LLM call and return only the parsed model"""
+    completion = await client.chat.completions.create(
         model=model,
+        messages=messages,
+        response_format=response_formats[response_model],
+    )
+    log_usage(stage, completion)
+    # model_validate_json parses and validates the raw JSON in one pass (pydantic-core),
+    # without building an intermediate dict first
+    return response_model.model_validate_json(completion.choices[0].message.content)
+
+
+async def extract_event_info(user_input: str, date_context: str) -> EventExtraction:
+    """First LLM call to determine if input is a calendar event"""
+    logger.info("Starting event extraction analysis")
+    logger.debug(f"Input text: {user_input}")
+
+    if not might_be_calendar_event(user_input):
+        logger.info("Pre-filter: no scheduling keywords or time found, skipping LLM")
+        return EventExtraction(
+            description=user_input, is_calendar_event=False, confidence_score=0.0
+        )
+
+    result = await parse_completion(
+        stage="extract",
+        model=stage_models["extract"],
         messages=[
             {
                 "role": "system",
-                "content": f"{date_context} Extract detailed event information. When dates reference 'next Tuesday' or similar relative dates, use this current date as reference.",
+                "content": f"{extract_system_prompt}\n\n{date_context}",
             },
-            {"role": "user", "content": description},
+            {"role": "user", "content": user_input},
         ],
-        response_format=EventDetails,
+        response_model=EventExtraction,
     )
-    result = completion.choices[0].message.parsed
     logger.info(
-        f"Parsed event details - Name: {result.name}, Date: {result.date}, Duration: {result.duration_minutes}min"
+        f"Extraction complete - Is calendar event: {result.is_calendar_event}, Confidence: {result.confidence_score:.2f}"
     )
-    logger.debug(f"Participants: {', '.join(result.participants)}")
     return result
 
 
-def generate_confirmation(event_details: EventDetails) -> EventConfirmation:
-    """Third LLM call to generate a confirmation message"""
-    logger.info("Generating confirmation message")
+async def parse_and_confirm(description: str, date_context: str) -> ParsedAndConfirmed:
+    """Second LLM call to extract event details and generate a confirmation message"""
+    logger.info("Starting event details parsing and confirmation")
 
-    completion = client.beta.chat.completions.parse(
-        model=model,
+    # Parsing and confirming in one call saves a full round trip; the confirmation
+    # only depends on the details, which the model produces first in the same response
+    result = await parse_completion(
+        stage="parse_and_confirm",
+        model=stage_models["parse_and_confirm"],
         messages=[
             {
                 "role": "system",
-                "content": "Generate a natural confirmation message for the event. Sign of with your name; Susie",
+                "content": f"{parse_and_confirm_system_prompt}\n\n{date_context}",
             },
-            {"role": "user", "content": str(event_details.model_dump())},
+            {"role": "user", "content": description},
         ],
-        response_format=EventConfirmation,
+        response_model=ParsedAndConfirmed,
     )
-    result = completion.choices[0].message.parsed
+    details = result.details
+    logger.info(
+        f"Parsed event details - Name: {details.name}, Date: {details.date}, Duration: {details.duration_minutes}min"
+    )
+    logger.debug(f"Participants: {', '.join(details.participants)}")
     logger.info("Confirmation message generated successfully")
     return result
 
@@ -135,61 +319,185 @@ def generate_confirmation(event_details: EventDetails) -> EventConfirmation:
 # --------------------------------------------------------------
 
 
-def process_calendar_request(user_input: str) -> Optional[EventConfirmation]:
+def passes_gate(extraction: EventExtraction) -> bool:
+    """Gate check: Verify if it's a calendar event with sufficient confidence"""
+    if not extraction.is_calendar_event or extraction.confidence_score < 0.7:
+        logger.warning(
+            f"Gate check failed - is_calendar_event: {extraction.is_calendar_event}, confidence: {extraction.confidence_score:.2f}"
+        )
+        return False
+
+    logger.info("Gate check passed, proceeding with event processing")
+    return True
+
+
+async def process_calendar_request(user_input: str) -> Optional[EventConfirmation]:
     """Main function implementing the prompt chain with gate check"""
     logger.info("Processing calendar request")
     logger.debug(f"Raw input: {user_input}")
 
+    # Compute the date once, so all stages see the same date for this request
+    date_context = get_date_context(date.today().toordinal())
+
     # First LLM call: Extract basic info
-    initial_extraction = extract_event_info(user_input)
+    initial_extraction = await extract_event_info(user_input, date_context)
 
     # Gate check: Verify if it's a calendar event with sufficient confidence
-    if (
-        not initial_extraction.is_calendar_event
-        or initial_extraction.confidence_score < 0.7
-    ):
-        logger.warning(
-            f"Gate check failed - is_calendar_event: {initial_extraction.is_calendar_event}, confidence: {initial_extraction.confidence_score:.2f}"
-        )
+    if not passes_gate(initial_extraction):
         return None
 
-    logger.info("Gate check passed, proceeding with event processing")
-
-    # Second LLM call: Get detailed event information
-    event_details = parse_event_details(initial_extraction.description)
-
-    # Third LLM call: Generate confirmation
-    confirmation = generate_confirmation(event_details)
+    # Second LLM call: Get detailed event information and generate confirmation
+    result = await parse_and_confirm(initial_extraction.description, date_context)
 
     logger.info("Calendar request processing completed successfully")
-    return confirmation
+    return result.confirmation
 
 
 # --------------------------------------------------------------
-# Step 4: Test the chain with a valid input
+# Step 4: Test the chain with a valid and an invalid input
 # --------------------------------------------------------------
 
-user_input = "Let's schedule a 1h team meeting next Tuesday at 2pm with Alice and Bob to discuss the project roadmap."
+inputs = [
+    "Let's schedule a 1h team meeting next Tuesday at 2pm with Alice and Bob to discuss the project roadmap.",
+    "Can you send an email to Alice and Bob to discuss the project roadmap?",
+]
+
+# Limit the number of requests in flight to stay within the API rate limits
+semaphore = asyncio.Semaphore(20)
+
+
+async def process_with_limit(user_input: str) -> Optional[EventConfirmation]:
+    async with semaphore:
+        start = time.perf_counter()
+        result = await process_calendar_request(user_input)
+        logger.info(f"Request processed in {time.perf_counter() - start:.2f}s")
+        return result
+
+
+async def main():
+    # The requests are independent, so run them concurrently. Total wall time is
+    # that of the slowest request rather than the sum of all of them.
+    start = time.perf_counter()
+    results = await asyncio.gather(*[process_with_limit(u) for u in inputs])
+    logger.info(
+        f"Processed {len(inputs)} requests in {time.perf_counter() - start:.2f}s"
+    )
+    return results
 
-result = process_calendar_request(user_input)
-if result:
-    print(f"Confirmation: {result.confirmation_message}")
-    if result.calendar_link:
-        print(f"Calendar Link: {result.calendar_link}")
-else:
-    print("This doesn't appear to be a calendar event request.")
+
+for result in asyncio.run(main()):
+    if result:
+        print(f"Confirmation: {result.confirmation_message}")
+        if result.calendar_link:
+            print(f"Calendar Link: {result.calendar_link}")
+    else:
+        print("This doesn't appear to be a calendar event request.")
+
+log_usage_summary()
 
 
 # --------------------------------------------------------------
-# Step 5: Test the chain with an invalid input
+# Step 5: Run a larger test suite offline with the Batch API
 # --------------------------------------------------------------
 
-user_input = "Can you send an email to Alice and Bob to discuss the project roadmap?"
+"""
+docs: https://platform.openai.com/docs/guides/batch
+
+For regression suites and other runs that don't need an answer right away, the
+gate check for all inputs can run as a single batch job: roughly half the price and
+with separate, much higher rate limits. Inputs that pass the gate continue through
+the regular chain. Keep the async path above for interactive use. Set RUN_BATCH=1
+to run it.
+"""
+
+
+async def run_batch(
+    user_inputs: list[str], date_context: str, poll_interval: int = 30
+) -> list[Optional[EventExtraction]]:
+    """Run the first LLM call for all inputs as one batch job"""
+    requests = [
+        {
+            "custom_id": f"req-{i}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": stage_models["extract"],
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": f"{extract_system_prompt}\n\n{date_context}",
+                    },
+                    {"role": "user", "content": user_input},
+                ],
+                "response_format": response_formats[EventExtraction],
+            },
+        }
+        for i, user_input in enumerate(user_inputs)
+    ]
+    batch_input = "\n".join(json.dumps(request) for request in requests)
+
+    batch_file = await client.files.create(
+        file=("calendar_requests.jsonl", batch_input.encode("utf-8")),
+        purpose="batch",
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    logger.info(f"Batch {batch.id} created for {len(user_inputs)} requests")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(poll_interval)
+        batch = await client.batches.retrieve(batch.id)
+
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} finished with status: {batch.status}")
+
+    # Match results on custom_id, failed requests stay None
+    extractions: list[Optional[EventExtraction]] = [None] * len(user_inputs)
+    if batch.output_file_id:
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            record = json.loads(line)
+            if record.get("error") or record["response"]["status_code"] != 200:
+                continue
+            content = record["response"]["body"]["choices"][0]["message"]["content"]
+            index = int(record["custom_id"].removeprefix("req-"))
+            extractions[index] = EventExtraction.model_validate_json(content)
+    return extractions
+
+
+async def process_calendar_requests_offline(
+    user_inputs: list[str],
+) -> list[Optional[EventConfirmation]]:
+    """Gate all inputs in one batch job, then complete the chain for those that pass"""
+    date_context = get_date_context(date.today().toordinal())
+    # Obvious negatives are rejected by the pre-filter and never enter the batch
+    candidates = [i for i, u in enumerate(user_inputs) if might_be_calendar_event(u)]
+    extractions: list[Optional[EventExtraction]] = [None] * len(user_inputs)
+    if candidates:
+        batch_results = await run_batch(
+            [user_inputs[i] for i in candidates], date_context
+        )
+        for i, extraction in zip(candidates, batch_results):
+            extractions[i] = extraction
+
+    async def complete(extraction: Optional[EventExtraction]):
+        if extraction is None or not passes_gate(extraction):
+            return None
+        async with semaphore:
+            result = await parse_and_confirm(extraction.description, date_context)
+        return result.confirmation
+
+    return await asyncio.gather(*[complete(e) for e in extractions])
+
+
+if os.getenv("RUN_BATCH") == "1":
+    for result in asyncio.run(process_calendar_requests_offline(inputs)):
+        if result:
+            print(f"Confirmation: {result.confirmation_message}")
+        else:
+            print("This doesn't appear to be a calendar event request.")
 
-result = process_calendar_request(user_input)
-if result:
-    print(f"Confirmation: {result.confirmation_message}")
-    if result.calendar_link:
-        print(f"Calendar Link: {result.calendar_link}")
-else:
-    print("This doesn't appear to be a calendar event request.")
+    log_usage_summary()
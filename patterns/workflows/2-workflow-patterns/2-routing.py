@@ -1,5 +1,5 @@
 from typing import Optional, Literal
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from openai import OpenAI
 import os
 import logging
@@ -23,6 +23,8 @@ model = "gpt-4o"
 class CalendarRequestType(BaseModel):
     """Router LLM call: Determine the type of calendar request"""
 
+    model_config = ConfigDict(extra="forbid")
+
     request_type: Literal["new_event", "modify_event", "other"] = Field(
         description="Type of calendar request being made"
     )
@@ -33,6 +35,8 @@ class CalendarRequestType(BaseModel):
 class NewEventDetails(BaseModel):
     """Details for creating a new event"""
 
+    model_config = ConfigDict(extra="forbid")
+
     name: str = Field(description="Name of the event")
     date: str = Field(description="Date and time of the event (ISO 8601)")
     duration_minutes: int = Field(description="Duration in minutes")
@@ -42,6 +46,8 @@ class NewEventDetails(BaseModel):
 class Change(BaseModel):
     """Details for changing an existing event"""
 
+    model_config = ConfigDict(extra="forbid")
+
     field: str = Field(description="Field to change")
     new_value: str = Field(description="New value for the field")
 
@@ -49,6 +55,8 @@ class Change(BaseModel):
 class ModifyEventDetails(BaseModel):
     """Details for modifying an existing event"""
 
+    model_config = ConfigDict(extra="forbid")
+
     event_identifier: str = Field(
         description="Description to identify the existing event"
     )
@@ -65,6 +73,26 @@ class CalendarResponse(BaseModel):
     calendar_link: Optional[str] = Field(description="Calendar link if applicable")
 
 
+def json_schema_format(response_model: type[BaseModel]) -> dict:
+    """The response_format parameter for a model, with strict schema validation"""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_model.__name__,
+            "schema": response_model.model_json_schema(),
+            "strict": True,
+        },
+    }
+
+
+# Built once, used by every call below
+response_formats = {
+    CalendarRequestType: json_schema_format(CalendarRequestType),
+    NewEventDetails: json_schema_format(NewEventDetails),
+    ModifyEventDetails: json_schema_format(ModifyEventDetails),
+}
+
+
 # --------------------------------------------------------------
 # Step 2: Define the routing and processing functions
 # --------------------------------------------------------------
@@ -74,7 +102,7 @@ def route_calendar_request(user_input: str) -> CalendarRequestType:
     """Router LLM call to determine the type of calendar request"""
     logger.info("Routing calendar request")
 
-    completion = client.beta.chat.completions.parse(
+    completion = client.chat.completions.create(
         model=model,
         messages=[
             {
@@ -83,9 +111,11 @@ def route_calendar_request(user_input: str) -> CalendarRequestType:
             },
             {"role": "user", "content": user_input},
         ],
-        response_format=CalendarRequestType,
+        response_format=response_formats[CalendarRequestType],
+    )
+    result = CalendarRequestType.model_validate_json(
+        completion.choices[0].message.content
     )
-    result = completion.choices[0].message.parsed
     logger.info(
         f"Request routed as: {result.request_type} with confidence: {result.confidence_score}"
     )
@@ -97,7 +127,7 @@ def handle_new_event(description: str) -> CalendarResponse:
     logger.info("Processing new event request")
 
     # Get event details
-    completion = client.beta.chat.completions.parse(
+    completion = client.chat.completions.create(
         model=model,
         messages=[
             {
@@ -106,9 +136,9 @@ def handle_new_event(description: str) -> CalendarResponse:
             },
             {"role": "user", "content": description},
         ],
-        response_format=NewEventDetails,
+        response_format=response_formats[NewEventDetails],
     )
-    details = completion.choices[0].message.parsed
+    details = NewEventDetails.model_validate_json(completion.choices[0].message.content)
 
     logger.info(f"New event: {details.model_dump_json(indent=2)}")
 
@@ -125,7 +155,7 @@ def handle_modify_event(description: str) -> CalendarResponse:
     logger.info("Processing event modification request")
 
     # Get modification details
-    completion = client.beta.chat.completions.parse(
+    completion = client.chat.completions.create(
         model=model,
         messages=[
             {
@@ -134,9 +164,11 @@ def handle_modify_event(description: str) -> CalendarResponse:
             },
             {"role": "user", "content": description},
         ],
-        response_format=ModifyEventDetails,
+        response_format=response_formats[ModifyEventDetails],
+    )
+    details = ModifyEventDetails.model_validate_json(
+        completion.choices[0].message.content
     )
-    details = completion.choices[0].message.parsed
 
     logger.info(f"Modified event: {details.model_dump_json(indent=2)}")
 